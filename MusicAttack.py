@@ -14,8 +14,11 @@ import keyboard
 
 import os       #os.getenv()
 from os.path import exists
+from pathlib import Path
 import time     #time.sleep()
 import json
+import collections
+import threading
 
 # Input Processing Utilities
 #
@@ -27,23 +30,39 @@ class IPU:
     DEFAULT_FSAMP = 48000
     DEFAULT_FRAME_SIZE = 800
     DEFAULT_FRAMES_PER_FFT = 1
+    DEFAULT_BUFFER_SIZE = 256
     DEFAULT_MIC_INDEX = 0
     DEFAULT_SENSITIVITY = 200
     NOTE_NAMES = 'C C# D D# E F F# G G# A A# B'.split()
     MONO = 1
+    FFT_PADDING = 4
 
     fsamp = 0
     frame_size = 0
     frames_per_fft = 0
+    buffer_size = 0
     mic_index = -1
     sensitivity = 0
     samples_per_fft = 0
     amplitude = 0.0
     buf = None
+    write_idx = 0
+    fresh_samples = 0
+    blocks = None
+    block_ready = None
+    window = None
+    window_gain = 0.0
+    windowed = None
+    fft_size = 0
+    band_start = 0
+    band_stop = 0
     note = 0
     note_name = ""
-    fourier_array = None
     piano_frequencies = None
+    mic_list_cache = None
+    mic_name_cache = None
+    note_edges = None
+    note_name_table = None
 
     def __init__(self):
         self.__pyaud = pyaudio.PyAudio()
@@ -51,11 +70,16 @@ class IPU:
         self.frame_size = self.DEFAULT_FRAME_SIZE
         self.frames_per_fft = self.DEFAULT_FRAMES_PER_FFT
         self.samples_per_fft = self.frame_size * self.frames_per_fft
+        self.buffer_size = self.DEFAULT_BUFFER_SIZE
         self.mic_index = self.DEFAULT_MIC_INDEX
         self.sensitivity = self.DEFAULT_SENSITIVITY
 
-        self.fourier_array = (-2 * np.pi / self.fsamp) * np.arange(self.samples_per_fft)
-        self.piano_frequencies = [self.number_to_freq(i) for i in np.arange(1, 89)]
+        self.piano_frequencies = self.number_to_freq(np.arange(1, 89, dtype=np.float32))
+
+        # Boundaries halfway (in log-frequency) between neighbouring keys,
+        # so a frequency can be snapped to its nearest key without a log2
+        self.note_edges = np.sqrt(self.piano_frequencies[:-1] * self.piano_frequencies[1:])
+        self.note_name_table = [self.note_to_note_name(n) for n in range(1, 89)]
     
     
     def get_pyaudio(self):
@@ -100,20 +124,69 @@ class IPU:
         if(not self.mic_index):
             self.mic_index=int(self.get_pyaudio().get_default_input_device_info()["index"])
             #print(self.mic_index)
-            self.set_sampling_rate(int(self.get_pyaudio().get_device_info_by_index(self.mic_index)["defaultSampleRate"]))
+            # Set directly: set_sampling_rate() would call start() again and
+            # open a second stream feeding the same callback
+            self.sampling_rate=int(self.get_pyaudio().get_device_info_by_index(self.mic_index)["defaultSampleRate"])
             #print(self.getSamplingRate())
         try:
-            self.buf = np.zeros(self.samples_per_fft, dtype=np.float32)
+            # Twice the window length; see write_samples()
+            self.buf = np.zeros(2 * self.samples_per_fft, dtype=np.int16)
+            self.write_idx = 0
+            self.fresh_samples = 0
+            # Hann window, and the float32 buffer it is applied into
+            self.window = np.hanning(self.samples_per_fft).astype(np.float32)
+            self.window_gain = float(self.window.sum())
+            self.windowed = np.empty(self.samples_per_fft, dtype=np.float32)
+            # Zero-pad the FFT to a power of two at least FFT_PADDING times
+            # the window, giving finer bins for the peak interpolation
+            self.fft_size = 1 << int(np.ceil(np.log2(self.FFT_PADDING * self.samples_per_fft)))
+            # FFT bins that can hold a piano note, up to a quarter tone
+            # past either end of the keyboard (never DC or Nyquist)
+            bin_width = self.fsamp / self.fft_size
+            quarter_tone = 2 ** (1 / 24)
+            self.band_start = max(1, int(np.floor(self.piano_frequencies[0] / quarter_tone / bin_width)))
+            self.band_stop = min(int(np.ceil(self.piano_frequencies[-1] * quarter_tone / bin_width)) + 1, self.fft_size // 2)
+            # Blocks delivered by audio_callback(), waiting for calculate_note().
+            # Enough are kept to cover a whole window if calculate_note() falls behind.
+            self.blocks = collections.deque(maxlen=-(-self.samples_per_fft // self.buffer_size) + 1)
+            self.block_ready = threading.Event()
             self.stream=self.get_pyaudio().open(format=pyaudio.paInt16,
                                                channels=self.MONO,
                                                input_device_index=int(self.mic_index),
                                                rate=self.fsamp,
                                                input=True,
-                                               frames_per_buffer=self.frame_size)
+                                               frames_per_buffer=self.buffer_size,
+                                               stream_callback=self.audio_callback)
         except OSError:
             print("Error: The selected input had trouble initializing.\nPlease check if you have selected the correct input and try again.\n")
             exit()
 
+    # Runs on PortAudio's thread whenever a block has been captured,
+    # so recording carries on while calculate_note() is busy
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        self.blocks.append(in_data)
+        self.block_ready.set()
+        return (None, pyaudio.paContinue)
+
+    # Write samples into both halves of the ring buffer so the latest
+    # samples_per_fft samples are always one contiguous slice
+    def write_samples(self, samples):
+        size = self.samples_per_fft
+        samples = samples[-size:]
+        start = self.write_idx
+
+        # Split the write where it wraps past the end of the window
+        first = min(samples.size, size - start)
+        self.buf[start:start + first] = samples[:first]
+        self.buf[start + size:start + size + first] = samples[:first]
+        rest = samples.size - first
+        if rest:
+            self.buf[:rest] = samples[first:]
+            self.buf[size:size + rest] = samples[first:]
+
+        self.write_idx = (start + samples.size) % size
+        self.fresh_samples += samples.size
+
     def stop(self):
         self.stream.stop_stream()
         self.stream.close() 
@@ -148,43 +221,65 @@ class IPU:
 
 
 
-    def discrete_fourier_transform(self, f, samples):
-        fourier_array_times_freq = f * self.fourier_array
-        #return np.absolute(np.sum(samples * np.exp(1j * fourier_array_times_freq))) / samples.size
-        x = np.sum(samples * np.cos(fourier_array_times_freq))
-        y = np.sum(samples * np.sin(fourier_array_times_freq))
-        return np.sqrt(x*x+y*y) / samples.size
-
-
+    # Find the loudest FFT bin in the piano's range, then fit a parabola through
+    # it and its two neighbours to estimate where the true peak lies between bins
     def get_dominant_pitch(self, samples):
-        response = [self.discrete_fourier_transform(f, samples) for f in self.piano_frequencies]
-        max_index = np.argmax(response)
-        return self.piano_frequencies[max_index], response[max_index]
+        # Windowing also converts the int16 samples to float32
+        np.multiply(samples, self.window, out=self.windowed)
+
+        # Only look at the piano band, plus one bin either side for the
+        # interpolation. Squared magnitudes are enough to find the peak,
+        # so only the three bins used below need a square root.
+        band = np.fft.rfft(self.windowed, self.fft_size)[self.band_start - 1:self.band_stop + 1]
+        power = band.real * band.real + band.imag * band.imag
+        k = int(power[1:-1].argmax()) + 1
+
+        # At a band edge the bin outside the band can be louder, and the
+        # parabola through three non-peak points can land anywhere, so
+        # only interpolate around a true local maximum
+        left, peak, right = np.sqrt(power[k-1:k+2])
+        denominator = left - 2*peak + right
+        if peak >= left and peak >= right and denominator:
+            offset = 0.5 * (left - right) / denominator
+        else:
+            offset = 0.0
+
+        # Dividing by the window's sum keeps amplitudes on the same scale
+        # as an unwindowed transform, so sensitivity still means the same
+        return (self.band_start - 1 + k + offset) * self.fsamp / self.fft_size, peak / self.window_gain
     ######################################################################
 
+    # Enumerating devices queries PortAudio once per device, so the
+    # result is kept until invalidate_mic_list() is called
     def get_microphone_list(self):
+        if(self.mic_list_cache is not None):
+            return(self.mic_list_cache)
+
         retval={}
         adict=None
         for devindex in range(self.get_pyaudio().get_device_count()):
             adict=self.get_pyaudio().get_device_info_by_index(devindex)
             if(bool(int(adict["maxInputChannels"]))):
                 retval[adict["name"]]=adict["index"]
+        self.mic_list_cache=retval
+        self.mic_name_cache={value: key for key, value in retval.items()}
         return(retval)     
 
+    def invalidate_mic_list(self):
+        self.mic_list_cache=None
+        self.mic_name_cache=None
+
     def get_microphone_name(self):
         # Cancel if microphone is not set
         if self.mic_index == -1:
             return("NULL")
 
-        retval={}
-        adict=self.get_microphone_list()
-
-        for key, value in adict.items():
-            if value == self.mic_index:
-                return(key)
+        self.get_microphone_list()
+        return(self.mic_name_cache.get(self.mic_index))
 
     def set_microphone_index(self, index):
         self.mic_index=index
+        self.invalidate_mic_list()
         if(self.stream):
             self.stop()
 
@@ -210,23 +305,39 @@ class IPU:
     # Result can be passed as an arg thru function note_name() to get note name, i.e. A4
     def calculate_note(self):
         if(self.stream):
-            # Shift the buffer down and new data in
-            self.buf[:-self.frame_size] = self.buf[self.frame_size:]
-            self.buf[-self.frame_size:] = np.frombuffer(self.stream.read(self.frame_size), np.int16)
-
-            # Run the DFFT on the buffer
-            self.dominant_frequency, self.amplitude = self.get_dominant_pitch(self.buf)# * window)
+            # Collect small blocks from the audio callback until a frame's
+            # worth of new samples is in. Keep the previous result if they
+            # don't arrive in time.
+            while self.fresh_samples < self.frame_size:
+                if not self.block_ready.wait(2 * self.frame_size / self.fsamp):
+                    return
+                self.block_ready.clear()
+                while self.blocks:
+                    self.write_samples(np.frombuffer(self.blocks.popleft(), np.int16))
+            # Carry the leftover samples into the next frame so analyses average
+            # one per frame_size, but don't build up a backlog if we fell behind
+            self.fresh_samples %= self.frame_size
+
+            samples = self.buf[self.write_idx:self.write_idx + self.samples_per_fft]
+
+            # A windowed spectrum can never be louder than the loudest sample,
+            # so quiet frames can skip the DFFT altogether
+            if max(int(samples.max()), -int(samples.min())) < self.sensitivity:
+                self.amplitude = 0.0
+            else:
+                # Run the DFFT on the window
+                self.dominant_frequency, self.amplitude = self.get_dominant_pitch(samples)
 
             # Return 0 if sound isn't loud enough.
             #TODO: Move this to somewhere else so that testing can be done properly.
             if self.amplitude < self.sensitivity:
+                self.note = 0
                 self.note_name = 0
                 return
             else:
                 # Get note number and nearest note
-                n = self.freq_to_number(self.dominant_frequency)
-                self.note = int(round(n))
-                self.note_name = self.note_to_note_name(self.note)
+                self.note = int(np.searchsorted(self.note_edges, self.dominant_frequency)) + 1
+                self.note_name = self.note_name_table[self.note - 1]
 
     # Return a bar representation of amplitude, used in test()
     def amplitude_bar(self):
@@ -272,12 +383,11 @@ def get_panelattack_keys():
 
   # Load keys from file
     #TODO: Cross-platform the following lines
-    APPDATA = os.getenv("APPDATA")
-    keys_file = "\Panel Attack\keysV2.txt" 
-    KEYS_PATH = APPDATA + keys_file
+    APPDATA = os.getenv("APPDATA", "")
+    KEYS_PATH = Path(APPDATA) / "Panel Attack" / "keysV2.txt"
 
     try:
-        with open(KEYS_PATH) as file:
+        with KEYS_PATH.open() as file:
             loaded_file = json.load(file)
 
             btn_assignments["swap1"] = translate(str(loaded_file[0]["swap1"]))
@@ -289,22 +399,13 @@ def get_panelattack_keys():
 
             return btn_assignments
     except FileNotFoundError:
-        print("Error: \'" + KEYS_PATH + "\' not found.\nPlease verify Panel Attack is installed and keyboard keys are set.\nExiting.\n")
+        print("Error: \'" + str(KEYS_PATH) + "\' not found.\nPlease verify Panel Attack is installed and keyboard keys are set.\nExiting.\n")
         exit()
 
 # Used in create_config() to find most frequently occuring note
+# Expects a list of note numbers (1-88)
 def mode(ls):
-    # dictionary to keep count of each value
-    counts = {}
-    # iterate through the list
-    for item in ls:
-        if item in counts:
-            counts[item] += 1
-        else:
-            counts[item] = 1
-    # get the key with the max count
-    keys = [key for key in counts.keys() if counts[key] == max(counts.values())] 
-    return(keys[0])
+    return(int(np.bincount(ls).argmax()))
 
 # Contains code to interactively create config.json
 def create_config(configfile, ipu, panelattack_keys):
@@ -334,7 +435,7 @@ def create_config(configfile, ipu, panelattack_keys):
         while (i < len(recorded_notes)):
             print("\r" + str(pa_key) + "                              ", end='')
             ipu.calculate_note()
-            recorded_notes[i] = ipu.get_note_name()
+            recorded_notes[i] = ipu.get_note()
 
             if recorded_notes[i] == 0:
                 i = 0
@@ -344,7 +445,7 @@ def create_config(configfile, ipu, panelattack_keys):
                 time.sleep(0.1)
 
 
-        note_mode = mode(recorded_notes)
+        note_mode = ipu.note_name_table[mode(recorded_notes) - 1]
         new_config["keys"][note_mode] = key_list[pos]
 
         print("\r" + str(pa_key) + "\tBound note " + note_mode + " to button \'" + key_list[pos] + "\'")
@@ -437,22 +538,32 @@ def panel(ipu, config):
     print("Sound is now being translated to keys. Press Ctrl + C to stop.")
     ipu.start()
 
-    is_pressed = False
+    # Keybind for each note number (index 0 is silence), so the loop
+    # below doesn't have to look note names up in config every frame
+    key_by_note = [None] * 89
+    for n, name in enumerate(ipu.note_name_table, 1):
+        key_by_note[n] = config["keys"].get(name)
 
-    try:
-        while ipu.get_stream().is_active():
-            ipu.calculate_note()
-
-            try:
-                kbpress = config["keys"][ ipu.get_note_name() ]
-                if not is_pressed:
-                    keyboard.send(kbpress)
-                    #print(str(kbpress))
+    # Note whose key was last sent; it isn't sent again until released
+    pressed_note = 0
 
-                is_pressed = True
+    # Look the methods up once rather than on every frame
+    is_active = ipu.get_stream().is_active
+    calculate_note = ipu.calculate_note
+    get_note = ipu.get_note
 
-            except KeyError:
-                is_pressed = False
+    try:
+        while is_active():
+            calculate_note()
+            note = get_note()
+
+            kbpress = key_by_note[note]
+            if kbpress is None:
+                pressed_note = 0
+            elif note != pressed_note:
+                keyboard.send(kbpress)
+                #print(str(kbpress))
+                pressed_note = note
 
     except KeyboardInterrupt:
         ipu.stop()